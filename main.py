@@ -1,11 +1,24 @@
 import argparse
 import asyncio
-import time
-from PIL import ImageGrab, Image
+import collections
+import concurrent.futures
+import os
+from PIL import Image
 import csv
-import json
-import requests
-from transformers import FuyuProcessor, FuyuForCausalLM
+import mss
+import numpy as np
+import orjson
+import httpx
+from ocr import init_tesseract, process_image_with_tesseract
+
+PRECISIONS = {"fp16": "float16", "bf16": "bfloat16"}
+
+# CRM updates are short JSON function calls: stop at the end of the fenced JSON
+# block instead of always decoding up to the token cap.
+GENERATION_KWARGS = {
+    "max_new_tokens": 200,
+    "stop_strings": ["}\n```"],
+}
 
 # pylint: disable=pointless-string-statement
 """
@@ -22,94 +35,333 @@ Rules:
 """
 
 
+class CsvTable:
+    """CSV content kept as a header and tuple rows, with a memoized JSON serialization."""
+
+    __slots__ = ("fieldnames", "rows", "_json")
+
+    def __init__(self, fieldnames, rows):
+        self.fieldnames = fieldnames
+        self.rows = rows
+        self._json = None
+
+    def row_to_dict(self, row):
+        """Map a row to its fields the way csv.DictReader does for ragged rows.
+
+        Extra values are collected under the None key, missing fields are None.
+        """
+        record = dict(zip(self.fieldnames, row))
+        if len(row) > len(self.fieldnames):
+            record[None] = list(row[len(self.fieldnames) :])
+        for key in self.fieldnames[len(row) :]:
+            record[key] = None
+        return record
+
+    def to_json(self):
+        """Return the rows as a JSON list of objects, serialized on first use."""
+        if self._json is None:
+            # Compact JSON: indentation only costs prompt tokens.
+            self._json = orjson.dumps(
+                [self.row_to_dict(row) for row in self.rows],
+                option=orjson.OPT_NON_STR_KEYS,
+            ).decode()
+        return self._json
+
+
 def read_csv(file_path):
-    """Read a CSV file and return its content as a list of dictionaries. Create the file if it does not exist."""
+    """Read a CSV file and return its content as a CsvTable. Create the file if it does not exist."""
     try:
         with open(file_path, mode="r", newline="", encoding="utf-8") as file:
-            reader = csv.DictReader(file)
-            return [row for row in reader]
+            reader = csv.reader(file)
+            fieldnames = tuple(next(reader, ()))
+            # Skip blank lines, as csv.DictReader does.
+            return CsvTable(fieldnames, [tuple(row) for row in reader if row])
     except FileNotFoundError:
         with open(file_path, mode="w", newline="", encoding="utf-8") as file:
             writer = csv.DictWriter(file, fieldnames=[])
             writer.writeheader()
-        return []
+        return CsvTable((), [])
+
+
+# Screens at least this wide (HiDPI / 4K) are halved before OCR: UI text stays
+# readable and Tesseract's LSTM cost scales with the pixel count.
+OCR_DOWNSCALE_MIN_WIDTH = 2560
+
 
+def prepare_for_ocr(image):
+    """Convert an image to grayscale, halving its size on large screens."""
+    image = image.convert("L")
+    width, height = image.size
+    if width >= OCR_DOWNSCALE_MIN_WIDTH:
+        image = image.resize((width // 2, height // 2), Image.LANCZOS)
+    return image
 
-def capture_screen():
-    """Capture the screen and return the image."""
-    im = ImageGrab.grab(bbox=None).convert(
-        "RGB"
-    )  # Capture the whole screen and ensure the image is in RGB format
-    return im
 
+def capture_screen(sct):
+    """Capture the screen with a reusable mss handle and return the image."""
+    raw = sct.grab(sct.monitors[0])  # monitors[0] spans all screens
+    # Decode the BGRA backing buffer straight into an RGB image in a single pass,
+    # instead of grabbing an RGBA copy and converting it again. This also copies
+    # the pixels out of mss' buffer before the next grab() reuses it.
+    return Image.frombuffer("RGB", raw.size, raw.bgra, "raw", "BGRX", 0, 1)
 
-async def on_activity(activity: str):
-    """Trigger actions based on the activity text."""
+
+async def on_activity(activity: str, http=None, crm_url=None):
+    """Trigger actions based on the activity text, posting it to the CRM if configured."""
     print(activity)
+    if http is not None and crm_url:
+        try:
+            response = await http.post(crm_url, json={"activity": activity})
+            response.raise_for_status()
+        except (httpx.HTTPError, httpx.InvalidURL) as error:
+            print(f"Failed to update the CRM: {error}")
+
+
+PROMPT_PREFIX = (
+    "You are an AI assistant that gets screenshots from a user screen doing sales and your job is to update a CRM system with the data extracted from the screen."
+    "Leads CSV content: {leads}\n\n"
+    "Accounts CSV content: {accounts}\n\n"
+)
+PROMPT_SUFFIX = (
+    "Text extracted from the screen: {frames}\n\n"
+    "Return a JSON function call to update the CRM system with the processed text."
+)
+
+def build_prompt_prefix(leads, accounts):
+    """Build the static part of the prompt from the leads and accounts tables."""
+    return PROMPT_PREFIX.format(leads=leads.to_json(), accounts=accounts.to_json())
+
+
+def build_prompt(prompt_prefix, frames_text=()):
+    # Fuyu puts the image patches at the start of the sequence, so the static
+    # text prefix still sits after the (changing) images and its KV cache cannot
+    # be reused across batches; only the string building is shared.
+    batched_text = orjson.dumps(
+        {
+            "frames": [
+                {"frame_number": i + 1, "text": text}
+                for i, text in enumerate(frames_text)
+            ]
+        }
+    ).decode()
+    return prompt_prefix + PROMPT_SUFFIX.format(frames=batched_text)
+
+
+def load_image(path):
+    """Load an image file as RGB."""
+    return Image.open(path).convert("RGB")
+
+
+# Mean absolute difference (0-255) between two frame thumbnails under which the
+# screen is considered unchanged and the frame is dropped.
+FRAME_CHANGE_THRESHOLD = 2.0
+
+
+# Seconds without a new frame after which a partial batch is processed anyway, so
+# frames captured right before the screen goes idle are not held back.
+BATCH_IDLE_TIMEOUT = 10.0
+
+
+def frame_thumbnail(image):
+    """Return a small grayscale thumbnail used to detect screen changes."""
+    return np.asarray(image.resize((64, 36)).convert("L"), dtype=np.int16)
+
+
+def capture_frame(sct):
+    """Capture the screen and return the image along with its thumbnail."""
+    image = capture_screen(sct)
+    return image, frame_thumbnail(image)
+
+
+async def screen_frames(sleep_interval):
+    """Yield screen captures every `sleep_interval` seconds, skipping unchanged screens."""
+    loop = asyncio.get_running_loop()
+    # mss handles may only be used on the thread that created them: create, use
+    # and close the handle on one dedicated thread.
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as capture_thread:
+        sct = await loop.run_in_executor(capture_thread, mss.mss)
+        try:
+            previous_thumbnail = None
+            while True:
+                image, thumbnail = await loop.run_in_executor(
+                    capture_thread, capture_frame, sct
+                )
+                if (
+                    previous_thumbnail is None
+                    or np.abs(thumbnail - previous_thumbnail).mean()
+                    >= FRAME_CHANGE_THRESHOLD
+                ):
+                    previous_thumbnail = thumbnail
+                    yield image
+                await asyncio.sleep(sleep_interval)
+        finally:
+            await loop.run_in_executor(capture_thread, sct.close)
+
 
+DECODE_WORKERS = 8
 
-def build_prompt(leads, accounts):
 
-    prompt = (
-        f"You are an AI assistant that gets screenshots from a user screen doing sales and your job is to update a CRM system with the data extracted from the screen."
-        f"Leads CSV content: {json.dumps(leads, indent=4)}\n\n"
-        f"Accounts CSV content: {json.dumps(accounts, indent=4)}\n\n"
-        "Return a JSON function call to update the CRM system with the processed text."
+async def folder_frames(folder):
+    """Yield the images of a test data folder, in file name order."""
+    paths = [
+        os.path.join(folder, filename)
+        for filename in sorted(os.listdir(folder))
+        if filename.endswith((".png", ".jpg", ".jpeg"))
+    ]
+    loop = asyncio.get_running_loop()
+    # PNG/JPEG decoding releases the GIL: decode a window of files concurrently
+    # and yield them in order. The window only refills as frames are consumed, so
+    # the queue's backpressure also bounds decoding.
+    with concurrent.futures.ThreadPoolExecutor(max_workers=DECODE_WORKERS) as executor:
+        pending = collections.deque()
+        for path in paths:
+            pending.append(loop.run_in_executor(executor, load_image, path))
+            if len(pending) >= DECODE_WORKERS:
+                yield await pending.popleft()
+        while pending:
+            yield await pending.popleft()
+
+
+async def produce_frames(frames, queue, ocr_pool):
+    """Queue each frame along with its pending OCR result, then a final None."""
+    loop = asyncio.get_running_loop()
+    async for image in frames:
+        # Tesseract is single-threaded per call: OCR runs in the worker pool while
+        # the next frames are captured and the model generates.
+        ocr_image = await asyncio.to_thread(prepare_for_ocr, image)
+        text = loop.run_in_executor(ocr_pool, process_image_with_tesseract, ocr_image)
+        await queue.put((image, text))
+    await queue.put(None)
+
+
+async def consume_frames(
+    queue, batch_size, prompt_prefix, processor, model, activity_callback
+):
+    """Group queued frames into batches of `batch_size` and process each batch.
+
+    A partial batch is processed once no frame arrived for BATCH_IDLE_TIMEOUT,
+    and when the frames run out.
+    """
+    batch = []
+    while True:
+        try:
+            frame = await asyncio.wait_for(queue.get(), timeout=BATCH_IDLE_TIMEOUT)
+        except TimeoutError:
+            if batch:
+                await process_batch(
+                    batch, prompt_prefix, processor, model, activity_callback
+                )
+                batch = []
+            continue
+        if frame is None:
+            if batch:
+                await process_batch(
+                    batch, prompt_prefix, processor, model, activity_callback
+                )
+            break
+        batch.append(frame)
+        if len(batch) >= batch_size:
+            await process_batch(
+                batch, prompt_prefix, processor, model, activity_callback
+            )
+            batch = []
+
+
+def prepare_inputs(processor, prompt, images):
+    """Turn the prompt and images into model inputs on MPS."""
+    return processor(text=prompt, images=images, return_tensors="pt").to("mps")
+
+
+async def process_batch(frames, prompt_prefix, processor, model, activity_callback):
+    """Run the model on a batch of (image, OCR text) frames and hand the result to `activity_callback`."""
+    images = [image for image, _ in frames]
+    frames_text = await asyncio.gather(*(text for _, text in frames))
+    prompt = build_prompt(prompt_prefix, frames_text)
+    inputs = await asyncio.to_thread(prepare_inputs, processor, prompt, images)
+    generation_output = await asyncio.to_thread(
+        model.generate, **inputs, **GENERATION_KWARGS, tokenizer=processor.tokenizer
     )
-    return prompt
+    # Fuyu returns the prompt followed by the completion: keep only the latter.
+    generated_ids = generation_output[:, inputs["input_ids"].shape[1] :]
+    processed_text = processor.batch_decode(generated_ids, skip_special_tokens=True)[0]
+    activity_callback(processed_text)
 
 
-async def main_loop(batch_size, sleep_interval, test_data_folder):
+async def main_loop(
+    batch_size,
+    sleep_interval,
+    test_data_folder,
+    precision="bf16",
+    crm_url=None,
+    int4_weights=False,
+):
     """Main loop to capture screen, extract text, and process it with another model."""
+    # Imported here rather than at module level: OCR worker processes re-import
+    # this module under the spawn start method and must not load torch.
+    from transformers import (  # pylint: disable=import-outside-toplevel
+        FuyuForCausalLM,
+        FuyuProcessor,
+        QuantoConfig,
+    )
+
+    # Fail on a bad --crm_url before the slow model load, not on the first post.
+    if crm_url and httpx.URL(crm_url).scheme not in ("http", "https"):
+        raise ValueError(f"--crm_url must be an http(s) URL, got {crm_url!r}")
+
     leads = read_csv("leads.csv")
     accounts = read_csv("accounts.csv")
+    prompt_prefix = build_prompt_prefix(leads, accounts)
 
     model_id = "adept/fuyu-8b"
     processor = FuyuProcessor.from_pretrained(model_id)
-    model = FuyuForCausalLM.from_pretrained(model_id, device_map="mps")
-
-    images = []
+    # int4 weight-only quantization stores the weights in about a quarter of the
+    # memory. optimum-quanto only has fused int4 kernels on CUDA: on MPS weights
+    # are dequantized to `precision` on every forward, trading speed for memory.
+    quantization_config = QuantoConfig(weights="int4") if int4_weights else None
+    model = FuyuForCausalLM.from_pretrained(
+        model_id,
+        torch_dtype=PRECISIONS[precision],
+        device_map="mps",
+        # Never fall back to pickled .bin weights.
+        use_safetensors=True,
+        quantization_config=quantization_config,
+    )
 
     if test_data_folder:
-        import os
-        from PIL import Image
-
+        frames = folder_frames(test_data_folder)
+    else:
+        frames = screen_frames(sleep_interval)
 
-        for filename in sorted(os.listdir(test_data_folder)):
-            if filename.endswith((".png", ".jpg", ".jpeg")):
-                image = Image.open(os.path.join(test_data_folder, filename)).convert(
-                    "RGB"
-                )
-                images.append(image)
+    # Bounded so capture stays at most one batch ahead of generation.
+    queue = asyncio.Queue(maxsize=batch_size)
+    ocr_pool = concurrent.futures.ProcessPoolExecutor(
+        max_workers=os.cpu_count(), initializer=init_tesseract
+    )
+    # One pooled HTTP/2 connection shared by all CRM updates.
+    http = httpx.AsyncClient(http2=True, timeout=5.0) if crm_url else None
 
-            if len(images) >= batch_size:
-                prompt = build_prompt(leads, accounts)
-                inputs = processor(text=prompt, images=images, return_tensors="pt").to(
-                    "mps"
-                )
-                generation_output = model.generate(**inputs, max_new_tokens=500)
-                processed_text = processor.batch_decode(
-                    generation_output, skip_special_tokens=True
-                )[0]
-                await on_activity(processed_text)
-                images = []
-    else:
-        while True:
-            image = capture_screen()
+    try:
+        async with asyncio.TaskGroup() as tg:
 
-            if len(images) >= batch_size:
-                prompt = build_prompt(leads, accounts)
-                inputs = processor(
-                    text=prompt, images=images, return_tensors="pt"
-                ).to("mps")
-                generation_output = model.generate(**inputs, max_new_tokens=500)
-                processed_text = processor.batch_decode(
-                    generation_output, skip_special_tokens=True
-                )[0]
-                await on_activity(processed_text)
-                images = []
+            def report_activity(activity):
+                # Posted in the background so the CRM update overlaps the next batch.
+                tg.create_task(on_activity(activity, http, crm_url))
 
-            time.sleep(sleep_interval)
+            tg.create_task(produce_frames(frames, queue, ocr_pool))
+            tg.create_task(
+                consume_frames(
+                    queue,
+                    batch_size,
+                    prompt_prefix,
+                    processor,
+                    model,
+                    report_activity,
+                )
+            )
+    finally:
+        ocr_pool.shutdown()
+        if http is not None:
+            await http.aclose()
 
 
 if __name__ == "__main__":
@@ -134,12 +386,32 @@ if __name__ == "__main__":
         type=str,
         help="Path to folder containing test data.",
     )
+    parser.add_argument(
+        "--precision",
+        default="bf16",
+        choices=sorted(PRECISIONS),
+        help="Dtype of the model activations.",
+    )
+    parser.add_argument(
+        "--int4_weights",
+        action="store_true",
+        help="Quantize the model weights to int4 to save memory (slower decode on MPS).",
+    )
+    parser.add_argument(
+        "--crm_url",
+        default=None,
+        type=str,
+        help="URL to POST each CRM update to.",
+    )
 
     args = parser.parse_args()
     asyncio.run(
         main_loop(
             args.batch_size,
             args.sleep_interval,
-            args.test_data_file,
+            args.test_data_folder,
+            args.precision,
+            args.crm_url,
+            args.int4_weights,
         )
     )
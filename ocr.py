@@ -0,0 +1,44 @@
+"""Tesseract OCR for the worker processes of main.py.
+
+Kept free of heavy imports: with the spawn start method (macOS default), each
+worker imports this module to run its initializer. tesserocr itself is only
+imported in the workers, so the main process never loads libtesseract.
+"""
+
+import multiprocessing.util
+import os
+
+_tesseract_api = None
+
+
+def init_tesseract():
+    """Create the in-process Tesseract engine, kept resident across frames.
+
+    Used as the OCR worker process initializer, so each worker owns one engine,
+    ended when the worker exits.
+    """
+    global _tesseract_api  # pylint: disable=global-statement
+    # One OpenMP thread per engine: parallelism comes from the worker pool. This
+    # has to be set before libtesseract (and its OpenMP runtime) is loaded.
+    os.environ["OMP_THREAD_LIMIT"] = "1"
+    import tesserocr  # pylint: disable=import-outside-toplevel
+
+    # Point TESSDATA_PREFIX at the tessdata_fast models for faster LSTM inference.
+    _tesseract_api = tesserocr.PyTessBaseAPI(
+        path=os.environ.get("TESSDATA_PREFIX", tesserocr.get_languages()[0]),
+        lang="eng",
+        oem=tesserocr.OEM.LSTM_ONLY,
+        # Screens are scattered UI labels rather than pages of prose: sparse text
+        # mode skips the full page layout analysis.
+        psm=tesserocr.PSM.SPARSE_TEXT,
+    )
+    # Pool workers leave through multiprocessing's exit hooks, not atexit.
+    multiprocessing.util.Finalize(None, _tesseract_api.End, exitpriority=0)
+    return _tesseract_api
+
+
+def process_image_with_tesseract(image):
+    """Extract the text from an image with the resident Tesseract engine."""
+    _tesseract_api.SetImage(image)
+    _tesseract_api.Recognize()
+    return _tesseract_api.GetUTF8Text()